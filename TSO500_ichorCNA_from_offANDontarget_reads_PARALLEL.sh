@@ -18,9 +18,10 @@ set -eu -o pipefail
 
 DEBUGGING=false
 
-N_CORES_MAX=24  # also scales the requested amount of RAM -> this number * 2 = requested RAM in GB
-MB_PER_SCAFFOLD=2000
-MB_FOR_INSERT_SIZES=15000
+N_CORES_MAX=24  # also scales the requested amount of RAM -> this number * MB_PER_PROCESS = requested RAM in MB
+# per process: a pysam duplicate marking worker (2 htslib threads + the pair signature dict of one 5 Mbp chunk)
+# stays well below 1 GB; the mate fixing 'samtools sort' threads use their default of 768 MB each
+MB_PER_PROCESS=1000
 script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 if [ "$DEBUGGING" = "true" ]; then
   echo "this is the value of the variable script_dir in 'TSO500_ichorCNA_from_offANDontarget_reads_PARALLEL.sh': ${script_dir}"  # for debugging
@@ -75,8 +76,8 @@ function apply_to_each_bam(){
     echo "ERROR - provided path to ichorCNA directory directory '${ichor_installation_path}' either is inaccessible or does not exist! Exiting.."
     exit 2
   fi
-  use_scaff_mem_mb=$(expr $4 \* $MB_PER_SCAFFOLD)
-  use_total_mem_mb=$(expr $use_scaff_mem_mb \+ $MB_FOR_INSERT_SIZES)
+  # (insert sizes are counted in-process while marking duplicates -> no extra memory needed for them)
+  use_total_mem_mb=$(expr $4 \* $MB_PER_PROCESS)
 
   echo "will use ${use_total_mem_mb} MB in total per sample!"
   for sample_name in "${NAMES[@]}"; do  # WARNING - NAMES is a global array!
@@ -71,7 +71,7 @@ function pipeline(){
   #arg5 = path to parallelized mark duplicates python script
   markdup_script_path="${5}"
 
-  # markduplicates script uses now MarkDuplicatesWithMateCigar with patterned flowcell-specific parameters
+  # markduplicates script uses now pysam (SAMBLASTER-like pair signatures)
   # for parallelized duplicates marking!
   # (python3.13 on sy096 in TSO500ichorCNA conda environment)
 
@@ -103,7 +103,9 @@ function pipeline(){
   echo "INFO - will use temporary directory '${user_temp_dir}'"
   markdup_temp_dir="${user_temp_dir}/markDuplicates-${sample_name}"  # THIS MUST BE SAMPLE-SPECIFIC!
   mkdir -p "${markdup_temp_dir}"
-  trap "echo 'cleaning up temporary directory for marking duplicates..' && rm -rdf ${markdup_temp_dir}; conda deactivate" SIGINT SIGTERM
+  # markduplicates script writes the result BAM as '.partial' into the input directory until it is indexed
+  markdup_partial_bam="${input_directory_path}/${sample_name}.markdup.bam.partial"
+  trap "echo 'cleaning up temporary directory for marking duplicates..' && rm -rdf ${markdup_temp_dir} && rm -f ${markdup_partial_bam} ${markdup_partial_bam}.bai; conda deactivate" SIGINT SIGTERM
     # Skip markduplicates if already exists
   if [ -f "${input_directory_path}/${sample_name}.markdup.bam" ]; then
     echo "STEP1: MarkDuplicates already completed for ${sample_name}, skipping..."
@@ -114,7 +116,7 @@ function pipeline(){
     python3 "${markdup_script_path}" --input-bam "${input_directory_path}/${sample_name}.bam" --output-dir "${input_directory_path}" --processes ${proc_number} --temp-dir "${markdup_temp_dir}"
   fi
 
-  # delete temporary directory for sample if it still exists after marking duplicates with picard
+  # delete temporary directory for sample if it still exists after marking duplicates
   if [ -d "${markdup_temp_dir}" ]
   then
     rm -rf "${markdup_temp_dir}"
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
-from time import sleep
-from subprocess import CalledProcessError, SubprocessError
 from sys import exit
+import os
+import re
 from pathlib import Path
 import subprocess as subp
 from random import randint
-import multiprocessing as mp
-from collections import deque
-from shutil import which, move, rmtree
-from typing import Union as OneOf, List
+from tempfile import TemporaryFile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shutil import which, rmtree
+from typing import Union as OneOf, List, Tuple, Set, Dict
+from collections import Counter
 from argparse import ArgumentParser, Namespace
 
+import pysam
+from matplotlib.figure import Figure
+
 MAJOR_VERSION_NUMBER = 0
 MINOR_VERSION_NUMBER = 1
 PATCH_VERSION_NUMBER = 3
@@ -22,9 +26,44 @@ VERSION_STRING = f"v{MAJOR_VERSION_NUMBER}.{MINOR_VERSION_NUMBER}.{PATCH_VERSION
 # (PCR duplicates should actually not occur due to UMI wetlab protocol
 #  and in silico collapsing of this information)
 
+# larger htslib I/O buffer (htslib default: 32 KiB) -> far fewer read/write syscalls on the networked (Isilon)
+# staging drive; passed to samtools via '--input-fmt-option'/'--output-fmt-option' and to pysam via
+# 'format_options'
+HTS_IO_BLOCK_SIZE = 4 * 1024 * 1024  # bytes
+HTS_IO_BLOCK_SIZE_OPTION = f'block_size={HTS_IO_BLOCK_SIZE}'
+
+# duplicate read pair detection (see mark_duplicates_with_mate_cigar())
+CIGAR_OPERATION_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+CLIPPING_CIGAR_OPERATIONS = ('S', 'H')
+CLIPPING_CIGAR_OPERATION_CODES = (pysam.CSOFT_CLIP, pysam.CHARD_CLIP)  # as in AlignedSegment.cigartuples
+REFERENCE_CONSUMING_CIGAR_OPERATIONS = ('M', 'D', 'N', '=', 'X')
+MIN_SCORING_BASE_QUALITY = 15  # like samtools markdup
+# input BAM handles of the current worker process (see get_worker_input_bam())
+worker_input_bams = {}
+# work distribution: scaffolds are split into chunks which are processed by the next idle worker
+SCAFFOLD_CHUNK_LENGTH = 5_000_000  # bp
+# reads of neighbouring chunks are considered as duplicate candidates up to this distance (bp) from a chunk's
+# boundaries so that a read starting close to the boundary is compared against all of its competitors.
+# Competitors share their unclipped 5' end, so the distance that must be covered is how far apart their
+# reference_start (= the position used by fetch() and for assigning reads to chunks) can be: the 5' clipping
+# for forward reads; read length + 5' clipping + deletions for reverse reads (reference_start is at their 3'
+# end). The mate is irrelevant here (its position comes from the MC tag), so this is NOT related to the
+# insert size distribution - do not 'tune' it to an insert size percentile! 750 bp leaves a wide margin for
+# the 2x101 bp TSO500 reads; only increase it for longer reads or long deletions.
+CHUNK_BOUNDARY_BUFFER = 750  # bp
+# insert size metrics like Picard CollectInsertSizeMetrics (see write_insert_size_metrics())
+INSERT_SIZE_CORE_DEVIATIONS = 10  # MEAN/STANDARD_DEVIATION only within median +/- this number * MAD
+INSERT_SIZE_WIDTH_PERCENTAGES = (10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99)
+
+# executables are resolved once at import (not per function call or worker process)
 rsync_path = which('rsync')
-if not Path(rsync_path).is_file():
+if rsync_path is None or not Path(rsync_path).is_file():
     raise FileNotFoundError(f"the 'rsync' executable path was not found or is not accessible")
+samtools_path = which('samtools')
+if samtools_path is None or not Path(samtools_path).is_file():
+    raise FileNotFoundError("samtools executable not found on system path (looked through the eyes of "
+                            "shutil.which()). Terminating..")
+samtools_path = Path(samtools_path)
 
 
 def get_cmdline_args() -> Namespace:
@@ -41,28 +80,39 @@ def get_cmdline_args() -> Namespace:
     parser.add_argument('-o', '--output-dir', metavar='Directory', dest='output_dir', type=Path,
                         required=True)
     parser.add_argument('-p', '--processes', dest='parallel_processes', type=int, default=12,
-                        help='Number of logical cores that will be used to mark duplicates. Each core '
-                             'processes an entire scaffold. So for the human reference genome with '
-                             '24 large unique scaffolds, >23 would be ideal. >24 will only yield a minor '
-                             'performance improvement. Should be at least 12 for a significant performance '
-                             'gain.')
+                        help='Number of logical cores that will be used to mark duplicates. Scaffolds are '
+                             'split into chunks of 5 Mbp which are processed by the next idle core. '
+                             'Should be at least 12 for a significant performance gain.')
     return parser.parse_args()
 
 
+def run_piped_commands(commands: List[List[str]]) -> List[Tuple[int, str]]:
+    # runs 'command_1 | command_2 | ...' without a shell and returns (exit status, error output) of every
+    # stage (a shell pipe would only report the exit status of the last stage without 'set -o pipefail')
+    stage_processes = []
+    stage_error_files = []
+    for command_idx, command in enumerate(commands):
+        is_last_stage = command_idx == len(commands) - 1
+        stage_error_files.append(TemporaryFile())  # avoids blocking on a full stderr pipe
+        stage_processes.append(subp.Popen(command,
+                                          stdin=stage_processes[-1].stdout if stage_processes else None,
+                                          stdout=subp.DEVNULL if is_last_stage else subp.PIPE,
+                                          stderr=stage_error_files[-1]))
+        if len(stage_processes) > 1:  # only the downstream stage holds the pipe now (SIGPIPE on early exit)
+            stage_processes[-2].stdout.close()
+    stage_results = []
+    for stage_process, stage_error_file in zip(stage_processes, stage_error_files):
+        stage_process.wait()
+        stage_error_file.seek(0)
+        stage_results.append((stage_process.returncode, stage_error_file.read().decode(errors='replace')))
+        stage_error_file.close()
+    return stage_results
+
+
 def mark_duplicates_with_mate_cigar_parallel(bam_path: OneOf[str, Path], temp_dir: OneOf[str, Path],
                                              processes: int,
                                              complete_output_bam: OneOf[str, Path],  # needs to be controlled
-                                             complete_output_metrics_file: OneOf[str, Path]) -> Path:
-    try:
-        samtools_path = Path(which('samtools'))
-    except TypeError:  # TypeError: expected str, bytes or os.PathLike object, not NoneType
-        raise FileNotFoundError("samtools executable not found on system path (looked through the eyes of "
-                                "shutil.which()). Terminating..")  # re-raise proper exception
-    try:
-        picard_path = Path(which('picard'))
-    except TypeError:  # TypeError: expected str, bytes or os.PathLike object, not NoneType
-        raise FileNotFoundError("picard executable not found on system path (looked through the eyes of "
-                                "shutil.which())")  # re-raise proper exception
+                                             complete_output_metrics_file: OneOf[str, Path]) -> Tuple[Path, Counter]:
     half_processes = processes // 2
     if half_processes < 1:
         half_processes = 2
@@ -82,27 +132,32 @@ def mark_duplicates_with_mate_cigar_parallel(bam_path: OneOf[str, Path], temp_di
         rmtree(coordsorting_tmp_dir, ignore_errors=True)
     coordsorting_tmp_dir.mkdir(parents=True, exist_ok=True)
     coordsorted_temp_prefix = coordsorting_tmp_dir / bam_path.stem
-    # assemble piped command
-    mate_info_fixing_command = (f"{samtools_path} sort --threads {half_processes - 1} -n "
-                                f"-T {namesorted_temp_prefix} {bam_path} | "  # SORTING: 11 threads
-                                # ensure input to fixmate is name-sorted 
-                                # (BAM is likely corrdinate sorted)
-                                f"{samtools_path} fixmate -m - - | "  # MATE FIXING: 1 thread
-                                # adds required mate tags like 'MQ' (quality) and 'MC' (CIGAR string), 
-                                # if missing
-                                f"{samtools_path} sort --threads {half_processes - 1} "
-                                f"-l 1 "  # use lightest/fastest compression
-                                f"-o {fixed_bam_path} -T {coordsorted_temp_prefix} - && "  # SORTING: 11 threads
-                                f"{samtools_path} index {fixed_bam_path} {fixed_bam_path}.bai")  # BAM INDEXING: 1 thread (for portability, don't use -o option)
-    # ensure input to MarkDuplicatesWithMateCigar is coordinate-sorted
-    called_mate_fixing_cmd = subp.run(mate_info_fixing_command, encoding='utf-8', shell=True,
-                                      stderr=subp.PIPE, stdout=subp.PIPE)
-    try:
-        called_mate_fixing_cmd.check_returncode()
-    except subp.CalledProcessError:
-        print(f"Mate information fixing child process returned with non-zero exit status.\n"
-              f"This was the output: {called_mate_fixing_cmd.stdout}\n"
-              f"This was the error output: {called_mate_fixing_cmd.stderr}")
+    # assemble piped command (stages are chained via Popen; no shell -> exit status of every stage is checked)
+    # intermediate stages of the pipe emit uncompressed BAM (-u) -> no deflate/inflate between stages
+    mate_info_fixing_stages = [
+        [str(samtools_path), 'sort', '-u', '--threads', f'{half_processes - 1}', '-n',
+         '--input-fmt-option', HTS_IO_BLOCK_SIZE_OPTION,
+         '-T', str(namesorted_temp_prefix), str(bam_path)],  # SORTING: 11 threads
+        # ensure input to fixmate is name-sorted
+        # (BAM is likely corrdinate sorted)
+        [str(samtools_path), 'fixmate', '-u', '-m', '-', '-'],  # MATE FIXING: 1 thread
+        # adds required mate tags like 'MQ' (quality) and 'MC' (CIGAR string),
+        # if missing
+        [str(samtools_path), 'sort', '--threads', f'{half_processes - 1}',
+         '-l', '1',  # use lightest/fastest compression
+         '--output-fmt-option', HTS_IO_BLOCK_SIZE_OPTION,
+         # BAM INDEXING on the fly while writing -> no extra read pass for 'samtools index'
+         # ('##idx##' enforces a '.bai' instead of the default '.csi' index)
+         '--write-index', '-o', f'{fixed_bam_path}##idx##{fixed_bam_path}.bai',
+         '-T', str(coordsorted_temp_prefix), '-']]  # SORTING: 11 threads
+    # ensure input to duplicates marking is coordinate-sorted
+    mate_fixing_stage_results = run_piped_commands(commands=mate_info_fixing_stages)
+    if any([return_code for return_code, _error_output in mate_fixing_stage_results]):
+        print(f"Mate information fixing child process returned with non-zero exit status.\n" +
+              ''.join([f"Stage '{' '.join(stage_command[:2])}' exited with status {return_code}. "
+                       f"This was the error output: {error_output}\n"
+                       for stage_command, (return_code, error_output)
+                       in zip(mate_info_fixing_stages, mate_fixing_stage_results)]))
         exit(3)
     # delete the temporary directories for sorting again
     if namesorting_tmp_dir.is_dir():
@@ -110,341 +165,429 @@ def mark_duplicates_with_mate_cigar_parallel(bam_path: OneOf[str, Path], temp_di
     if coordsorting_tmp_dir.is_dir():
         rmtree(coordsorting_tmp_dir, ignore_errors=True)
 
-    # split reference scaffold list into approximately equal-sized lists of scaffolds (bp-wise)
-    ref_seq_order_command = f"""samtools view -H {fixed_bam_path} | grep '^@SQ' | awk -F'\t' '{{
-        for (i = 1; i <= NF; i++) {{ 
-            if ($i ~ /^SN:/) {{ split($i, a, ":"); sn = a[2] }}
-            if ($i ~ /^LN:/) {{ split($i, b, ":"); ln = b[2] }}
-        }}
-        print sn "," ln
-    }}'"""  # names only: f"samtools view -H {fixed_bam_path} | grep '^@SQ' | cut -f2 | sed 's/^SN://'"
-    called_ref_order_command = subp.run(ref_seq_order_command, shell=True, capture_output=True,
-                                        encoding='utf-8')
-    try:
-        called_ref_order_command.check_returncode()
-    except CalledProcessError:
-        raise SubprocessError(f"could not determine reference sequence order. Exiting ..")
-    ref_dict = {}
-    reference_names = []
-    _ = [(ref_dict.update({ref_name: ref_length}),
-          reference_names.append(ref_name))
-         for t in called_ref_order_command.stdout.strip().splitlines()
-         if (ref_name := t.split(',')[0]) and (ref_length := int(t.split(',')[1]))]
-    total_ref_length = sum(ref_dict.values())
-    optimal_split_length = total_ref_length // processes
-    # create scaffold lists for workers
-    worker_scaffold_lists = [[] for _l in range(processes)]
-    worker_scaffolds_cumulative_sums = [0 for _ in range(processes)]
-    descending_length_tuples = sorted(list(zip(reference_names, [ref_dict[r] for r in reference_names])),
-                                      key=lambda t: t[1], reverse=True)
-    for scaff_idx, (scaffold_name, scaffold_length) in enumerate(descending_length_tuples):
-        # check if adding to naive target is a valid choice
-        if worker_scaffolds_cumulative_sums[scaff_idx % processes] + scaffold_length < optimal_split_length:  # default
-            worker_scaffold_lists[scaff_idx % processes].append(scaffold_name)
-            worker_scaffolds_cumulative_sums[scaff_idx % processes] += scaffold_length
-        else:  # add to the list with the lowest cumulative base sum
-            shortest_list_index = worker_scaffolds_cumulative_sums.index(min(worker_scaffolds_cumulative_sums))
-            worker_scaffold_lists[shortest_list_index].append(scaffold_name)
-            worker_scaffolds_cumulative_sums[shortest_list_index] += scaffold_length
-    # create multiprocesses:
-    receiving_connections, child_sending_connections = zip(*[mp.Pipe(duplex=False)   # unpack these Connections!
-                                                             for _w_idx in range(parallel_processes)])
-    # create worker_kwargs
-    worker_kwargs = [{'bam_path': fixed_bam_path, 'temp_dir': temp_dir, 'output_bam': complete_output_bam,
-                      'output_metrics_file': complete_output_metrics_file, 'picard_path': picard_path,
-                      'scaffolds_to_process': worker_scaffold_lists[w_idx], 'samtools_path': samtools_path,
-                      'parent_connection': child_sending_connections[w_idx]}
-                     for w_idx in range(processes)]
-    # create workers
-    worker_processes = [mp.Process(target=mark_duplicates_with_mate_cigar, kwargs=worker_kwargs[worker_idx])
-                        for worker_idx in range(processes)]
-    # start all workers
-    _ = deque(map(lambda p: p.start(), worker_processes), maxlen=0)
-    # collect results
-    received_scaffold_files = []  # (output_bam, scaffold_metrics_file)
-    for r_c in receiving_connections:
-        received_scaffold_files.extend(r_c.recv())  # might fail here if the storage is full:
-        # srun: error: sy096: task 0: Exited with exit code 1
-    # check results and terminate if one of the subprocesses failed
-    if None in received_scaffold_files:
-        print(f'At least one (actually {sum([rbp is None for rbp in received_scaffold_files]):,}) single '
-              'scaffold duplicates marking process failed. Terminating ..')
-        exit(1)
-    received_scaffold_bam_paths, received_scaffold_metrics_files = zip(*received_scaffold_files)
+    # get reference scaffold names and lengths in header order (= output BAM order)
+    with pysam.AlignmentFile(str(fixed_bam_path), 'rb') as fixed_bam_file:
+        ref_dict = dict(zip(fixed_bam_file.references, fixed_bam_file.lengths))
+        reference_names = list(fixed_bam_file.references)
+    # split scaffolds into chunks of at most SCAFFOLD_CHUNK_LENGTH bp; chunks are processed by the next idle
+    # worker, so the longest scaffold (chr1) does not determine the wall-clock time anymore.
+    # Consecutive small scaffolds (chrM, unplaced, decoys, ..) are batched into a single multi-region chunk of
+    # at most SCAFFOLD_CHUNK_LENGTH bp to avoid per-chunk overhead (must be consecutive to keep the BAM order!)
+    scaffold_chunks = []  # list of lists of (scaffold, start, end) regions
+    small_scaffolds_group = []
+    small_scaffolds_group_length = 0
+    for scaffold_name in reference_names:
+        scaffold_length = ref_dict[scaffold_name]
+        if small_scaffolds_group and (scaffold_length >= SCAFFOLD_CHUNK_LENGTH or
+                                      small_scaffolds_group_length + scaffold_length > SCAFFOLD_CHUNK_LENGTH):
+            scaffold_chunks.append(small_scaffolds_group)
+            small_scaffolds_group = []
+            small_scaffolds_group_length = 0
+        if scaffold_length >= SCAFFOLD_CHUNK_LENGTH:
+            scaffold_chunks.extend([[(scaffold_name, chunk_start,
+                                      min(chunk_start + SCAFFOLD_CHUNK_LENGTH, scaffold_length))]
+                                    for chunk_start in range(0, scaffold_length, SCAFFOLD_CHUNK_LENGTH)])
+        elif scaffold_length:
+            small_scaffolds_group.append((scaffold_name, 0, scaffold_length))
+            small_scaffolds_group_length += scaffold_length
+    if small_scaffolds_group:
+        scaffold_chunks.append(small_scaffolds_group)
+    received_scaffold_files = []  # (chunk_index, output_bam)
+    # read counts of all chunks are summed up per scaffold (in header order) -> single metrics file per sample
+    scaffold_read_counts = {scaffold_name: [0, 0, 0] for scaffold_name in reference_names}
+    insert_size_histogram = Counter()  # merged from all chunks
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # longest-processing-time-first (LPT) scheduling: the next idle worker is always the least loaded one,
+        # so submitting the longest chunks first leaves only short chunks (scaffold ends, small scaffolds) for
+        # the tail (chunks are handed to workers in submission order)
+        chunk_futures = [executor.submit(mark_duplicates_with_mate_cigar, bam_path=fixed_bam_path,
+                                         temp_dir=temp_dir, output_bam=complete_output_bam,
+                                         chunk_index=chunk_index,  # chunk index = position in output BAM
+                                         chunk_regions=chunk_regions)
+                         for chunk_index, chunk_regions in sorted(
+                             enumerate(scaffold_chunks), reverse=True,
+                             key=lambda t: sum([region_end - region_start for _s, region_start, region_end in t[1]]))]
+        # collect results in order of completion
+        for chunk_future in as_completed(chunk_futures):
+            try:
+                chunk_result = chunk_future.result()
+            except Exception as e:  # e.g., BrokenProcessPool or unexpected pysam errors in a worker
+                print(f"Scaffold chunk duplicates marking process raised an exception: {e!r}")
+                chunk_result = None
+            # check results and terminate if one of the subprocesses failed
+            # (cancel all pending chunks; otherwise leaving the executor context would process all of them)
+            if chunk_result is None:
+                print('At least one single scaffold chunk duplicates marking process failed. Terminating ..')
+                executor.shutdown(wait=True, cancel_futures=True)
+                exit(1)
+            chunk_index, scaffold_bam_path, chunk_region_read_counts, chunk_insert_size_histogram = chunk_result
+            insert_size_histogram.update(chunk_insert_size_histogram)
+            for scaffold, *region_read_counts in chunk_region_read_counts:
+                scaffold_read_counts[scaffold] = [scaffold_count + region_count for scaffold_count, region_count
+                                                  in zip(scaffold_read_counts[scaffold], region_read_counts)]
+            received_scaffold_files.append((chunk_index, scaffold_bam_path))
+    write_duplicate_metrics(scaffold_read_counts=scaffold_read_counts,
+                            output_metrics_file=complete_output_metrics_file)
+    # create the correct order of DupMarked scaffold chunk BAMs
+    received_scaffold_files.sort(key=lambda t: t[0])
+    received_scaffold_bam_paths = [scaffold_bam_path for _chunk_index, scaffold_bam_path in received_scaffold_files]
     # samtools cat the individual scaffold BAMs in order
-    # move all scaffold metrics files to a 'metrics' directory in the output_dir
-    metrics_output_dir = complete_output_metrics_file.parent / f'{bam_path.stem}_scaffold_metrics'
-    metrics_output_dir.mkdir(parents=True, exist_ok=True)
-    for metrics_file in received_scaffold_metrics_files:  # move from scaffold temp to metrics file parent dir
-        if (metrics_output_dir / metrics_file.name).is_file():  # file already exists at destination
-            print(f"WARNING: mark duplicates metrics file ('{metrics_file.name}') already exists at "
-                  f"destination folder '{metrics_output_dir}'. Deleting destination ..")
-            (metrics_output_dir / metrics_file.name).unlink()
-        move(metrics_file, metrics_output_dir)
-    # TODO (restore feature broken by multiprocessing into scaffold-wise statistics): create function to
-    #  aggregate the statistics in all scaffold metrics files and re-create the complete metrics file!
-    # check if output BAM file exists -> delete if so!
-    concatenated_bam = temp_path / complete_output_bam.name
+    # concatenate directly into the target directory (single pass over the data instead of concatenating in
+    # the temporary directory and copying the result afterwards); the result is written under a temporary
+    # name and only renamed after successful indexing so that no incomplete '.markdup.bam' can be mistaken
+    # for a finished one
+    final_output_dir = complete_output_bam.parent
+    final_output_dir.mkdir(exist_ok=True, parents=True)
+    concatenated_bam = final_output_dir / f'{complete_output_bam.name}.partial'
     if concatenated_bam.is_file():
-        print(f"WARNING: output BAM file already exists in temporary directory. "
+        print(f"WARNING: incomplete output BAM file from a previous run exists in output directory. "
               f"Deleting it before concatenating scaffold BAM files ..")
         concatenated_bam.unlink()
-    # create the correct order of DupMarked scaffold BAMs
-    received_order = [rcv_scaf_path.stem.split('-')[-1] for rcv_scaf_path in received_scaffold_bam_paths]
-    ordered_scaffold_paths = [str(received_scaffold_bam_paths[received_order.index(order_scaff)])
-                              for order_scaff in reference_names]
+    ordered_scaffold_paths = [str(scaffold_bam_path) for scaffold_bam_path in received_scaffold_bam_paths]
 
-    concatenation_command = f"{samtools_path} cat {' '.join(ordered_scaffold_paths)} -o {concatenated_bam} "
-    concatenation_subprocess = subp.run(concatenation_command, shell=True, stdout=subp.PIPE, stderr=subp.PIPE)
+    concatenation_command = ([str(samtools_path), 'cat', '-@', f'{processes}', '--no-PG'] + ordered_scaffold_paths +
+                             ['-o', str(concatenated_bam)])  # 'samtools cat' cannot write an index on the fly
+    concatenation_subprocess = subp.run(concatenation_command, stdout=subp.PIPE, stderr=subp.PIPE)
     try:
         concatenation_subprocess.check_returncode()
     except subp.CalledProcessError:
         print(f"concatenation of scaffold BAM files failed. Terminating ..")
+        concatenated_bam.unlink(missing_ok=True)
         exit(1)
 
     # delete individual scaffold BAM files and their parent directories
     for scaffold_bam_paths in received_scaffold_bam_paths:
         rmtree(scaffold_bam_paths.parent, ignore_errors=True)  # also deletes the directory itself
     # delete the mate-fixed BAM file index
-    index_files = fixed_bam_path.parent.glob(f'{fixed_bam_path.stem}*.bai')
-    for idx_file in index_files:
-        idx_file.unlink()
+    with os.scandir(fixed_bam_path.parent) as temp_dir_entries:  # plain prefix/suffix check; no fnmatch
+        for temp_dir_entry in temp_dir_entries:
+            if temp_dir_entry.name.startswith(fixed_bam_path.stem) and temp_dir_entry.name.endswith('.bai'):
+                os.unlink(temp_dir_entry.path)
     # delete the mate-fixed BAM file and its index
     fixed_bam_path.unlink(missing_ok=True)
     # index the duplicates-marked BAM file
     index_path = Path(f"{str(concatenated_bam)}.bai")
-    index_command = [f"{samtools_path}", 'index', f'{concatenated_bam}', f'{index_path}']
+    index_command = [f"{samtools_path}", 'index', '-@', f'{processes}', f'{concatenated_bam}', f'{index_path}']
     indexing_subprocess = subp.run(index_command, stdout=subp.PIPE, stderr=subp.PIPE)
     try:
         indexing_subprocess.check_returncode()
     except subp.CalledProcessError:
         print(f"indexing of duplicates marked concatenated BAM file failed. Terminating ..")
+        concatenated_bam.unlink(missing_ok=True)
+        index_path.unlink(missing_ok=True)
         exit(1)
-    # move the BAM file and the index to the target directory
+    # move result BAM file and index to their final names (same directory -> rename only; no data is copied).
+    # The BAM file is renamed last: its appearance marks completion (the calling script skips samples for
+    # which '.markdup.bam' exists), so an existing BAM file is deleted before its index is replaced
     if complete_output_bam.is_file():
-        print(f"WARNING: output BAM file already exists. Deleting it before "
-              f"rsyncing result BAM file and index..")
+        print(f"WARNING: output BAM file already exists. Replacing it with the new result BAM file ..")
         complete_output_bam.unlink()
-    complete_output_bam_index_path = Path(f'{complete_output_bam}.bai')
-    if complete_output_bam_index_path.is_file():
-        print(f"WARNING: output BAM file index already exists. Deleting it before "
-              f"rsyncing..")
-        complete_output_bam_index_path.unlink()  # delete
-    # synchronize to target location
-    final_output_dir = complete_output_bam.parent
-    final_output_dir.mkdir(exist_ok=True, parents=True)
-    rsync_command = f'{rsync_path} --checksum {str(concatenated_bam)[:-1]}* {final_output_dir}/'
-    # trailing slash: place inside! Use shell=True to enable shell expansion of wildcard!
-    rsync_subprocess = subp.run(rsync_command, shell=True, stdout=subp.PIPE, stderr=subp.PIPE)
-    try:
-        rsync_subprocess.check_returncode()
-    except subp.CalledProcessError:
-        print(f"rsyncing duplicates marked concatenated BAM file and index failed. Terminating ..")
-        exit(1)
-    # delete the synchronized files (they will pop up in the )
-    index_path.unlink()
-    concatenated_bam.unlink()
-    return temp_path  # THIS DIRECTORY MUST BE SAMPLE-SPECIFIC!
+    os.replace(index_path, Path(f'{complete_output_bam}.bai'))
+    os.replace(concatenated_bam, complete_output_bam)
+    return temp_path, insert_size_histogram  # THIS DIRECTORY MUST BE SAMPLE-SPECIFIC!
 
 
-def compute_insert_size_metrics(input_bam_path: OneOf[str, Path], output_directory: OneOf[str, Path],
-                                sample_id: str = None) -> subp.Popen:
-    try:
-        picard_path = Path(which('picard'))
-    except TypeError:  # TypeError: expected str, bytes or os.PathLike object, not NoneType
-        raise FileNotFoundError("picard executable not found on system path (looked through the eyes of "
-                                "shutil.which())")  # re-raise proper exception
-    in_bam_path = Path(input_bam_path)
-    output_dir_path = Path(output_directory)  # this should be on the staging drive!
-    if in_bam_path.parent == output_dir_path:
-        raise ValueError(f"Output directory path must not be identical to input BAM parent directory!")
-    output_dir_path.mkdir(parents=True, exist_ok=True)
-    if sample_id is None:
-        sample_id = in_bam_path.name.split('.markdup.bam')[0]
-    metrics_output_path = output_dir_path / f'{sample_id}-insert_size_metrics.txt'
-    histogram_output_path = output_dir_path / f"{sample_id}-insert_size_histogram.pdf"
-    insert_sizes_tmp_dir = output_dir_path / f'{sample_id}-insert_sizes_tmp_dir'
-    if insert_sizes_tmp_dir.is_dir():
-        rmtree(insert_sizes_tmp_dir, ignore_errors=True)
-    insert_sizes_tmp_dir.mkdir(parents=True, exist_ok=True)
-    # assemble insert size metrices command:
-    insert_sizes_cmd = [str(picard_path), '-Xmx15g',
-                        'CollectInsertSizeMetrics',
-                        f'I="{input_bam_path}"',
-                        f'O="{metrics_output_path}"',
-                        f'H="{histogram_output_path}"',
-                        'M=0.05',
-                        f'TMP_DIR={insert_sizes_tmp_dir}']
-    insert_sizes_proc = subp.Popen(insert_sizes_cmd, encoding='utf-8', stderr=subp.PIPE, stdout=subp.PIPE)
-    return insert_sizes_proc, insert_sizes_tmp_dir
+def histogram_median(histogram: Counter) -> float:
+    # like htsjdk Histogram.getMedian(): mean of the two middle values for an even number of observations
+    total_count = sum(histogram.values())
+    middle_low = (total_count + 1) // 2
+    middle_high = total_count // 2 + 1
+    middle_low_value = middle_high_value = None
+    cumulative_count = 0
+    for value in sorted(histogram):
+        cumulative_count += histogram[value]
+        if middle_low_value is None and cumulative_count >= middle_low:
+            middle_low_value = value
+        if cumulative_count >= middle_high:
+            middle_high_value = value
+            break
+    return (middle_low_value + middle_high_value) / 2
+
+
+def format_metric_value(value: float) -> str:
+    # like Picard's FormatUtil: integral values without decimals, others with up to 6 decimals
+    return str(int(value)) if float(value).is_integer() else f'{value:.6f}'.rstrip('0')
+
+
+def write_duplicate_metrics(scaffold_read_counts: Dict[str, List[int]], output_metrics_file: OneOf[str, Path]):
+    # one table per sample: read counts of all chunks summed up per scaffold (header order) + a total row;
+    # columns: excluded (secondary/supplementary/no MC tag), examined and duplicate reads (both mates counted)
+    total_read_counts = [sum(read_counts) for read_counts in zip(*scaffold_read_counts.values())]
+    with open(output_metrics_file, 'wt') as f_metrics:
+        f_metrics.write("SCAFFOLD\tEXCLUDED_READS\tEXAMINED_READS\tDUPLICATE_READS\tDUPLICATE_FRACTION\n")
+        for scaffold, (excluded_reads, examined_reads, duplicate_reads) in (
+                list(scaffold_read_counts.items()) + [('ALL', total_read_counts)]):
+            duplicate_fraction = duplicate_reads / examined_reads if examined_reads else 0.
+            f_metrics.write(f"{scaffold}\t{excluded_reads}\t{examined_reads}\t{duplicate_reads}\t"
+                            f"{duplicate_fraction:.6f}\n")
+
+
+def write_insert_size_metrics(insert_size_histogram: Counter, output_directory: OneOf[str, Path],
+                              sample_id: str):
+    # Picard CollectInsertSizeMetrics-like output from the histogram collected while marking duplicates
+    # (first reads of properly paired, non-duplicate FR-oriented primary alignments; |TLEN| > 0)
+    insert_size_files_dir_path = Path(output_directory) / 'insert_sizes'
+    insert_size_files_dir_path.mkdir(parents=True, exist_ok=True)
+    metrics_output_path = insert_size_files_dir_path / f'{sample_id}-insert_size_metrics.txt'
+    histogram_output_path = insert_size_files_dir_path / f"{sample_id}-insert_size_histogram.pdf"
+    insert_sizes = sorted(insert_size_histogram)
+    read_pairs = sum(insert_size_histogram.values())
+    if not read_pairs:
+        print(f"WARNING: no properly paired reads found for insert size metrics of sample '{sample_id}'.")
+        return
+    median_insert_size = histogram_median(insert_size_histogram)
+    absolute_deviations = Counter()
+    for insert_size, count in insert_size_histogram.items():
+        absolute_deviations[abs(insert_size - median_insert_size)] += count
+    median_absolute_deviation = histogram_median(absolute_deviations)
+    mode_insert_size = max(insert_sizes, key=lambda i_s: insert_size_histogram[i_s])
+    # MEAN and STANDARD_DEVIATION of the 'core' distribution only (Picard default: DEVIATIONS=10)
+    core_histogram = {insert_size: count for insert_size, count in insert_size_histogram.items()
+                      if abs(insert_size - median_insert_size) <= INSERT_SIZE_CORE_DEVIATIONS *
+                      median_absolute_deviation}
+    core_read_pairs = sum(core_histogram.values())
+    mean_insert_size = sum([insert_size * count for insert_size, count in core_histogram.items()]) / core_read_pairs
+    standard_deviation = 0.0
+    if core_read_pairs > 1:  # sample standard deviation like htsjdk Histogram.getStandardDeviation()
+        standard_deviation = (sum([(insert_size - mean_insert_size) ** 2 * count
+                                   for insert_size, count in core_histogram.items()]) / (core_read_pairs - 1)) ** 0.5
+    # WIDTH_OF_X_PERCENT: width of the bins centered around the median that encompass X% of all read pairs
+    insert_size_widths = {}
+    covered_read_pairs = 0
+    lower_insert_size = upper_insert_size = int(median_insert_size)
+    while lower_insert_size >= insert_sizes[0] or upper_insert_size <= insert_sizes[-1]:
+        covered_read_pairs += insert_size_histogram.get(lower_insert_size, 0)
+        if upper_insert_size != lower_insert_size:
+            covered_read_pairs += insert_size_histogram.get(upper_insert_size, 0)
+        for width_percentage in INSERT_SIZE_WIDTH_PERCENTAGES:
+            if width_percentage not in insert_size_widths and covered_read_pairs * 100 >= width_percentage * read_pairs:
+                insert_size_widths[width_percentage] = upper_insert_size - lower_insert_size + 1
+        lower_insert_size -= 1
+        upper_insert_size += 1
+    metrics_columns = {'MEDIAN_INSERT_SIZE': format_metric_value(median_insert_size),
+                       'MODE_INSERT_SIZE': mode_insert_size,
+                       'MEDIAN_ABSOLUTE_DEVIATION': format_metric_value(median_absolute_deviation),
+                       'MIN_INSERT_SIZE': insert_sizes[0],
+                       'MAX_INSERT_SIZE': insert_sizes[-1],
+                       'MEAN_INSERT_SIZE': format_metric_value(mean_insert_size),
+                       'STANDARD_DEVIATION': format_metric_value(standard_deviation),
+                       'READ_PAIRS': read_pairs,
+                       'PAIR_ORIENTATION': 'FR'}
+    metrics_columns.update({f'WIDTH_OF_{width_percentage}_PERCENT': insert_size_widths.get(width_percentage, 0)
+                            for width_percentage in INSERT_SIZE_WIDTH_PERCENTAGES})
+    metrics_columns.update({'SAMPLE': '', 'LIBRARY': '', 'READ_GROUP': ''})  # All_Reads level only
+    with open(metrics_output_path, 'wt') as f_metrics:
+        f_metrics.write("## METRICS CLASS\tpicard.analysis.InsertSizeMetrics\n"
+                        + '\t'.join(metrics_columns) + '\n'
+                        + '\t'.join([str(value) for value in metrics_columns.values()]) + '\n\n'
+                        "## HISTOGRAM\tjava.lang.Integer\n"
+                        "insert_size\tAll_Reads.fr_count\n")
+        f_metrics.write(''.join([f"{insert_size}\t{insert_size_histogram[insert_size]}\n"
+                                 for insert_size in insert_sizes]))
+    # histogram plot (Figure API: no pyplot/GUI backend required on cluster nodes)
+    histogram_figure = Figure(figsize=(10, 6))
+    histogram_axes = histogram_figure.subplots()
+    histogram_axes.bar(insert_sizes, [insert_size_histogram[insert_size] for insert_size in insert_sizes],
+                       width=1.0, color='tab:blue')
+    histogram_axes.axvline(median_insert_size, color='black', linestyle='--',
+                           label=f'median: {format_metric_value(median_insert_size)} bp')
+    histogram_axes.set_xlim(0, min(insert_sizes[-1], median_insert_size + INSERT_SIZE_CORE_DEVIATIONS *
+                                                      max(median_absolute_deviation, 1)))
+    histogram_axes.set_xlabel('insert size (bp)')
+    histogram_axes.set_ylabel('read pairs')
+    histogram_axes.set_title(f'Insert size histogram for {sample_id} ({read_pairs:,} read pairs)')
+    histogram_axes.legend()
+    histogram_figure.savefig(histogram_output_path)
+
+
+def is_on_same_filesystem(path_a: OneOf[str, Path], path_b: OneOf[str, Path]) -> bool:
+    # both paths must exist
+    return Path(path_a).stat().st_dev == Path(path_b).stat().st_dev
+
+
+def move_directory_contents(source_directory: OneOf[str, Path], destination_folder: OneOf[str, Path]):
+    # same-filesystem replacement for 'rsync -rl source/ destination/': files are renamed (no data is copied),
+    # existing directories are merged and existing files are replaced
+    for source_entry in Path(source_directory).iterdir():
+        destination_entry = Path(destination_folder) / source_entry.name
+        if source_entry.is_dir() and not source_entry.is_symlink():
+            destination_entry.mkdir(exist_ok=True)
+            move_directory_contents(source_directory=source_entry, destination_folder=destination_entry)
+        else:
+            os.replace(source_entry, destination_entry)
 
 
 def rsync_results_to_output_dir(source_directory: OneOf[str, Path], destination_folder: OneOf[str, Path]):
     if not destination_folder.is_dir():
         destination_folder.mkdir(parents=True, exist_ok=True)
         rmtree(destination_folder, ignore_errors=True)
-    rsync_command = [str(rsync_path), '-rl', '--checksum',
-                     f'{source_directory}/',  # trailing slash to synchronize all content! (insert sizes dir)
-                     f'{destination_folder}/']  # trailing slash to place all content into the destination!
-    rsync_subprocess = subp.run(rsync_command, stdout=subp.PIPE, stderr=subp.PIPE)
-    try:
-        rsync_subprocess.check_returncode()
-    except subp.CalledProcessError:
-        print(f"rsyncing results from duplicate marking and insert size metrics computation failed. "
-              f"Terminating before deleting temporary directory '{source_directory}' ..")
-        exit(1)
+    if destination_folder.is_dir() and is_on_same_filesystem(source_directory, destination_folder):
+        move_directory_contents(source_directory=source_directory, destination_folder=destination_folder)
+    else:
+        rsync_command = [str(rsync_path), '-rl', '--whole-file', '--inplace',  # no checksum/delta-transfer scans
+                         f'{source_directory}/',  # trailing slash to synchronize all content! (insert sizes dir)
+                         f'{destination_folder}/']  # trailing slash to place all content into the destination!
+        rsync_subprocess = subp.run(rsync_command, stdout=subp.PIPE, stderr=subp.PIPE)
+        try:
+            rsync_subprocess.check_returncode()
+        except subp.CalledProcessError:
+            print(f"rsyncing results from duplicate marking and insert size metrics computation failed. "
+                  f"Terminating before deleting temporary directory '{source_directory}' ..")
+            exit(1)
     rmtree(source_directory, ignore_errors=True)  # is outside the scaffold_bam_paths.parent directory!
 
 
-# execution requires GATK4+ to be present with Picard MarkDuplicatesWithMateCigar
+def unclipped_five_prime_position(reference_start: int, cigar_string: str, is_reverse: bool) -> int:
+    # 5' position of the mate as if soft/hard clipped bases were aligned (0-based, like pysam); the mate's
+    # alignment is only available as CIGAR string ('MC' tag)
+    cigar_operations = [(int(op_length), operation)
+                        for op_length, operation in CIGAR_OPERATION_PATTERN.findall(cigar_string)]
+    if is_reverse:  # 5' end is the rightmost aligned base + trailing clips
+        cigar_operations.reverse()
+    clipped_bases = 0
+    for op_length, operation in cigar_operations:
+        if operation not in CLIPPING_CIGAR_OPERATIONS:
+            break
+        clipped_bases += op_length
+    if not is_reverse:
+        return reference_start - clipped_bases
+    aligned_reference_length = sum([op_length for op_length, operation in cigar_operations
+                                    if operation in REFERENCE_CONSUMING_CIGAR_OPERATIONS])
+    return reference_start + aligned_reference_length - 1 + clipped_bases
+
+
+def read_unclipped_five_prime_position(read: pysam.AlignedSegment) -> int:
+    # same as unclipped_five_prime_position() for the read itself, but from the already decoded alignment
+    # (cigartuples + reference_end) instead of a re-parsed CIGAR string
+    cigar_tuples = read.cigartuples
+    clipped_bases = 0
+    for operation, op_length in (reversed(cigar_tuples) if read.is_reverse else cigar_tuples):
+        if operation not in CLIPPING_CIGAR_OPERATION_CODES:
+            break
+        clipped_bases += op_length
+    if read.is_reverse:
+        return read.reference_end - 1 + clipped_bases
+    return read.reference_start - clipped_bases
+
+
+def pair_duplicate_signature(read: pysam.AlignedSegment) -> OneOf[Tuple[int, ...], None]:
+    # SAMBLASTER-like signature of a read pair: both unclipped 5' ends + strands, ordered such that both
+    # mates of a pair produce the identical signature (requires 'MC' tag from 'samtools fixmate -m')
+    if not read.has_tag('MC'):
+        return None
+    own_end = (read.reference_id, read_unclipped_five_prime_position(read), int(read.is_reverse))
+    mate_end = (read.next_reference_id,
+                unclipped_five_prime_position(read.next_reference_start, read.get_tag('MC'),
+                                              read.mate_is_reverse),
+                int(read.mate_is_reverse))
+    return own_end + mate_end if own_end <= mate_end else mate_end + own_end
+
+
+def pair_quality_score(read: pysam.AlignedSegment) -> int:
+    # same score as samtools markdup: sum of base qualities >= 15 of the read plus the mate score ('ms'
+    # tag from 'samtools fixmate -m') -> identical for both mates of a pair
+    own_score = sum([base_quality for base_quality in (read.query_qualities or [])
+                     if base_quality >= MIN_SCORING_BASE_QUALITY])
+    return own_score + (read.get_tag('ms') if read.has_tag('ms') else 0)
+
+
+def is_markable_read(read: pysam.AlignedSegment) -> bool:
+    # primary alignments of mapped read pairs only; secondary/supplementary alignments are written unchanged
+    return read.is_paired and not (read.is_secondary or read.is_supplementary)
+
+
+def find_best_pair_read_names(alignment_file: pysam.AlignmentFile, scaffold: str, region_start: int,
+                              region_end: int) -> Set[str]:
+    # read names of the best (score, read name) pair per pair signature, including reads up to
+    # CHUNK_BOUNDARY_BUFFER bp outside of the region. A pair has exactly one signature (identical for both
+    # mates), so a pair is no duplicate if and only if its read name is in the returned set.
+    best_pairs = {}
+    for read in alignment_file.fetch(scaffold, max(0, region_start - CHUNK_BOUNDARY_BUFFER),
+                                     region_end + CHUNK_BOUNDARY_BUFFER):
+        if read.is_unmapped or read.mate_is_unmapped or not is_markable_read(read):
+            continue
+        signature = pair_duplicate_signature(read)
+        if signature is None:
+            continue
+        candidate = (pair_quality_score(read), read.query_name)
+        if candidate > best_pairs.get(signature, (-1, '')):
+            best_pairs[signature] = candidate
+    return {best_read_name for _best_score, best_read_name in best_pairs.values()}
+
+
+def get_worker_input_bam(bam_path: OneOf[str, Path]) -> pysam.AlignmentFile:
+    # opens the (mate-fixed) input BAM only once per worker process: BAM header and '.bai' index are parsed
+    # once and reused for all chunks this worker processes instead of being re-read for every chunk.
+    # Handles are closed when the worker process exits.
+    if str(bam_path) not in worker_input_bams:
+        worker_input_bams[str(bam_path)] = pysam.AlignmentFile(
+            str(bam_path), 'rb', threads=2, format_options=[HTS_IO_BLOCK_SIZE_OPTION.encode()])
+    return worker_input_bams[str(bam_path)]
+
+
+# execution requires pysam to be present (htslib bindings; no JVM or subprocess per scaffold)
 def mark_duplicates_with_mate_cigar(bam_path: OneOf[str, Path], temp_dir: OneOf[str, Path],
-                                    output_bam: OneOf[str, Path], output_metrics_file: OneOf[str, Path],
-                                    scaffolds_to_process: List[str], parent_connection: mp.Pipe,
-                                    picard_path: OneOf[str, Path], samtools_path: OneOf[str, Path]):
-    created_files = []
-    # create duplicates-marked scaffold BAMs
-    for scaffold in scaffolds_to_process:
-        scaffold_temp_dir = temp_dir / f'{scaffold}-{randint(0, 9999999):07}/tmp'
-        scaffold_temp_dir.mkdir(parents=True, exist_ok=True)
-        scaffold_output_bam = scaffold_temp_dir.parent / f'{output_bam.stem}-{scaffold}.bam'
-        scaffold_metrics_file = scaffold_temp_dir.parent / (f"{output_metrics_file.stem}-{scaffold}."
-                                                            f"{output_metrics_file.name.split('.')[-1]}")
-        # samtools filters out unaligned reads before marking duplicates
-        # (command terminates otherwise if unaligned reads are present)
-        # -F 12 means remove any read pair for which either the read or the mate is unmapped
-        # WARNING - this command requires a correct software environment to be active!
-        # (e.g., TSO500ichorCNA of Benjamin on MedBioNode)
-
-        # the chained command below uses 2 processes -> scaffold selection & duplicates marking
-        paired_end_dup_marking_cmd = (f"{samtools_path} view -h -F 12 --uncompressed {bam_path} {scaffold} | "
-                                      # 24 of these processes will use max of 24x2 = 48 Gb
-                                      f"{picard_path} -Xmx2g MarkDuplicatesWithMateCigar "  # 1 thread
-                                      f"INPUT=/dev/stdin "
-                                      f"TMP_DIR={scaffold_temp_dir}/tmp "
-                                      f"OUTPUT={scaffold_output_bam} "
-                                      f"METRICS_FILE={scaffold_metrics_file} "
-                                      f"ASSUME_SORTED=true "
-                                      # why can I use /dev/stdin and why does it not interfere between 
-                                      # different processes?
-                                      # ++++++++++++++++++++
-                                      # /dev/stdin is a symbolic link to /proc/self/fd/0, and THUS process specific!
-                                      # /proc/self is a symbolic link only seen by your running process to its 
-                                      # process-id; The /proc filesystem is a virtual (not real) filesystem which can 
-                                      # show a different view to each process.
-                                      # --MINIMUM_DISTANCE <Integer>
-                                      #   The minimum distance to buffer records to account for clipping on 
-                                      #   the 5' end of the records. For a given alignment, this parameter 
-                                      #   controls the width of the window to search for duplicates of that 
-                                      #   alignment. Due to 5' read clipping, duplicates do not necessarily
-                                      #   have the same 5' alignment coordinates, so the algorithm needs to 
-                                      #   search around the neighborhood. For single end sequencing data, the 
-                                      #   neighborhood is only determined by the amount of clipping (assuming 
-                                      #   no split reads), thus setting MINIMUM_DISTANCE to twice the 
-                                      #   sequencing read length should be sufficient. For paired end 
-                                      #   sequencing, the neighborhood is also determined by the fragment 
-                                      #   insert size, so you may want to set MINIMUM_DISTANCE to something 
-                                      #   like twice the 99.5% percentile of the fragment insert size 
-                                      #   distribution (see CollectInsertSizeMetrics). Or you can set this 
-                                      #   number to -1 to use either a) twice the first read's read length, 
-                                      #   or b) 100, whichever is smaller. Note that the larger the window, 
-                                      #   the greater the RAM requirements, so you could run into performance 
-                                      #   limitations if you use a value that is unnecessarily large.
-                                      #   Default value: -1.
-                                      #   99th percentile insert size for samples of run '250627_TSO500_Onco':
-                                      #   395 bp, 409 bp, 427 bp, 437 bp, 475 bp, 607 bp, 631 bp
-                                      "MINIMUM_DISTANCE=750 "
-                                      "COMPRESSION_LEVEL=2 "  # default is 2
-                                      "CREATE_INDEX=true "  # Creates '{file_path.stem}.bai' index file
-                                      # --MAX_RECORDS_IN_RAM <Integer>
-                                      #   When writing files that need to be sorted, this will specify the 
-                                      #   number of records stored in RAM before spilling to disk. Increasing 
-                                      #   this number reduces the number of file handles needed to sort the 
-                                      #   file, and increases the amount of RAM needed.
-                                      #   Default value: 500000.
-                                      "MAX_RECORDS_IN_RAM=1000000 "
-                                      # Illumina patterned flowcell:
-                                      # --OPTICAL_DUPLICATE_PIXEL_DISTANCE <Integer>
-                                      #   The maximum offset between two duplicate clusters to consider them 
-                                      #   optical duplicates. The default is appropriate for unpatterned 
-                                      #   versions of the Illumina platform. For the patterned flowcell 
-                                      #   models, 2500 is more appropriate. For other platforms and models, 
-                                      #   users should experiment to find what works best.
-                                      #   Default value: 100.
-                                      "OPTICAL_DUPLICATE_PIXEL_DISTANCE=2500 "
-                                      "REMOVE_DUPLICATES=false")  # make it explicit -> we only tag
-        # --REMOVE_DUPLICATES <Boolean> If true do not write duplicates to the output file instead of
-        #   writing them with appropriate flags set.
-        #   Default value: false.
-        #   Possible values: {true, false}
-        #
-        # detected about 15% duplication after all in sample ~10 GB input BAM file:
-        # (BAM file shrinks to 8.4 GB after fixing mate information)
-        # '/home/isilon/HumGenTempData/for_Raul_TSO500/Data_for_ichor/250611_TSO500_Onco-RECREATIONNEWSCRIPT/
-        #  L186_1-ONC_tumor.mateFixed.sorted.bam'
-        paired_end_dup_marking_cmd = subp.run(paired_end_dup_marking_cmd, encoding='utf-8', shell=True,
-                                              stderr=subp.PIPE, stdout=subp.PIPE)
-        try:
-            paired_end_dup_marking_cmd.check_returncode()
-            created_files.append((scaffold_output_bam, scaffold_metrics_file))
-        except subp.CalledProcessError:
-            print(f"Duplicates marking child process returned with non-zero exit status for scaffold "
-                  f"'{scaffold}'.\n"
-                  f"This was the output: {paired_end_dup_marking_cmd.stdout}\n"
-                  f"This was the error output: {paired_end_dup_marking_cmd.stderr}")
-            created_files.append(None)
-            break  # one failure is enough to quit
-    if None in created_files:
-        parent_connection.send(None)
-    else:
-        parent_connection.send(created_files)  # might send an empty list if no scaffolds were received
-    parent_connection.close()
-
-
-def wait_for_insert_metrics(process_handle: subp.Popen, metrics_output_dir: OneOf[str, Path],
-                            delete_temp_dir: OneOf[str, Path], sample_id: str, max_wait_minutes: int = 180):
-    wait_time = 0
-    waited_hours = waited_minutes = waited_seconds = 0
-    while process_handle.poll() is None:
-        print("waiting for insert metrics to finish..")
-        sleep(10)
-        wait_time += 10
-        waited_hours, remainder = divmod(wait_time, 3600)
-        waited_minutes, waited_seconds = divmod(remainder, 60)
-        if wait_time // 60 >= max_wait_minutes:
-            waited_hours, remainder = divmod(wait_time, 3600)
-            waited_minutes, waited_seconds = divmod(remainder, 60)
-            process_handle.terminate()
-            process_handle.wait() # close the process!
-            if process_handle.stdout:
-                process_handle.stdout.close()
-            if process_handle.stderr:
-                process_handle.stderr.close()
-            raise TimeoutError(f"waited now {waited_hours:02}:{waited_minutes:02}:{waited_seconds:02} "
-                               "(hh:mm:ss) for insert size metrics to finish. I don't wanna wait anymore!")
-    # read stdout und stderr:
-    process_stdout, process_stderr = process_handle.communicate()
-    # process finished; move on
-    if wait_time:
-        print(f"INFO - waited {waited_hours:02}:{waited_minutes:02}:{waited_seconds:02} (hh:mm:ss) "
-              f"for insert size metrics to finish.")
-    if process_handle.returncode:
-        print(f"Insert sizes computation child process returned with non-zero exit.\n"
-              f"This was the output: {process_stdout}\n"
-              f"This was the error output: {process_stderr}")
-        exit(1)
-    output_dir_path = Path(metrics_output_dir)
-    # create a subdirectory containing all the insert size metrics
-    insert_size_files_dir_path = output_dir_path / 'insert_sizes'
-    insert_size_files_dir_path.mkdir(parents=True, exist_ok=True)  # may have been created by another process
-    content_pattern = f'{sample_id}-insert_size_*'
-    for file_objct in output_dir_path.glob(content_pattern):
-        if file_objct.is_file():
-            move(file_objct, f'{insert_size_files_dir_path}/{Path(file_objct).name}')
-        elif file_objct.is_dir():
-            move(file_objct, f'{insert_size_files_dir_path}/{Path(file_objct).name}/')
-    # delete obsolete insert size metrics tmp directory
-    if delete_temp_dir.is_dir():
-        rmtree(delete_temp_dir)
+                                    output_bam: OneOf[str, Path], chunk_index: int,
+                                    chunk_regions: List[Tuple[str, int, int]]
+                                    ) -> OneOf[Tuple[int, Path, List[Tuple[str, int, int, int]], Counter], None]:
+    # create a duplicates-marked scaffold chunk BAM from one or more (consecutive) regions and collect the
+    # insert sizes of its non-duplicate pairs on the fly (no extra pass over the final BAM required).
+    # Read counts are returned per region as (scaffold, excluded, examined, duplicates) and aggregated per
+    # scaffold by the parent process
+    first_scaffold, first_start, first_end = chunk_regions[0]
+    if len(chunk_regions) == 1:
+        chunk_name = f'{first_scaffold}_{first_start + 1}-{first_end}'  # 1-based, inclusive
+    else:  # group of small scaffolds
+        chunk_name = f'{first_scaffold}-to-{chunk_regions[-1][0]}_group{chunk_index:05}'
+    # reads are kept in coordinate order, so the pair with the best score for a signature cannot be known
+    # when its first competitor is written -> 2 passes over each (indexed) region:
+    #   1) find the best (score, read name) per pair signature, including reads up to
+    #      CHUNK_BOUNDARY_BUFFER bp outside of the region
+    #   2) write all reads starting inside the region, setting the 0x400 flag on primary alignments of all
+    #      other pairs (reads starting outside are written by the neighbouring chunk)
+    # Ties are resolved by the read name so that both mates of a pair get the same decision, even if
+    # they are located in chunks processed by different workers.
+    # Unaligned reads are filtered out before marking duplicates:
+    # (equivalent to 'samtools view -F 12' -> remove any read for which either the read or the mate is
+    #  unmapped)
+    region_read_counts = []
+    insert_size_histogram = Counter()
+    try:
+        scaffold_dir = temp_dir / f'{chunk_name}-{randint(0, 9999999):07}'
+        scaffold_dir.mkdir(parents=True, exist_ok=True)  # might fail here if the storage is full
+        scaffold_output_bam = scaffold_dir / f'{output_bam.stem}-{chunk_name}.bam'
+        scaffold_input = get_worker_input_bam(bam_path=bam_path)  # shared by all chunks of this worker
+        with pysam.AlignmentFile(str(scaffold_output_bam), 'wb', template=scaffold_input, threads=2,
+                                 format_options=[HTS_IO_BLOCK_SIZE_OPTION.encode()]) as scaffold_output:
+            for scaffold, region_start, region_end in chunk_regions:
+                best_read_names = find_best_pair_read_names(alignment_file=scaffold_input, scaffold=scaffold,
+                                                            region_start=region_start, region_end=region_end)
+                examined_reads = duplicate_reads = excluded_reads = 0
+                for read in scaffold_input.fetch(scaffold, region_start, region_end):
+                    if read.reference_start < region_start or read.is_unmapped or read.mate_is_unmapped:
+                        continue
+                    # same selection as in find_best_pair_read_names(); no 2nd signature computation required
+                    if not is_markable_read(read) or not read.has_tag('MC'):
+                        excluded_reads += 1
+                    else:
+                        examined_reads += 1
+                        # we only tag duplicates (they are kept in the output)
+                        read.is_duplicate = read.query_name not in best_read_names
+                        duplicate_reads += read.is_duplicate
+                        # count each pair once (first read); like Picard, duplicates are not counted.
+                        # Only FR pairs (forward read upstream of reverse mate) are counted; RF and tandem
+                        # pairs are minor categories for this library type (dropped by Picard's M=0.05)
+                        if read.is_read1 and read.is_proper_pair and not read.is_duplicate and \
+                                read.template_length and read.is_reverse != read.mate_is_reverse and \
+                                (read.template_length > 0) != read.is_reverse:
+                            insert_size_histogram[abs(read.template_length)] += 1
+                    scaffold_output.write(read)
+                region_read_counts.append((scaffold, excluded_reads, examined_reads, duplicate_reads))
+    except (OSError, ValueError) as e:
+        print(f"Duplicates marking failed for scaffold chunk '{chunk_name}'.\n"
+              f"This was the error: {e}")
+        return None
+    return chunk_index, scaffold_output_bam, region_read_counts, insert_size_histogram
 
 
 if __name__ == '__main__':
@@ -467,17 +610,13 @@ if __name__ == '__main__':
     metrics_file = Path(output_dir) / f"{input_bam.stem}.markdup.metrics"
     output_bam_path = Path(output_dir) / f"{input_bam.stem}.markdup.bam"
     output_dir.mkdir(parents=True, exist_ok=True)
-    # STEP1a: asynchronously compute insert size metrics from duplicates-marked BAM file
-    insert_metrics_process, insert_szs_tmp_path = compute_insert_size_metrics(
-        input_bam_path=input_bam, sample_id=sample_name, output_directory=temp_dir)
-    # STEP1b: function below runs samtools fixmate and then executes picard MarkDuplicatesWithMateCigar
-    rsync_this_dirs_contents = mark_duplicates_with_mate_cigar_parallel(
+    # STEP1: function below runs samtools fixmate and then marks duplicates per scaffold using pysam
+    # (insert sizes are collected from the duplicates-marked reads at the same time)
+    rsync_this_dirs_contents, insert_sizes_histogram = mark_duplicates_with_mate_cigar_parallel(
         bam_path=input_bam, temp_dir=temp_dir, processes=parallel_processes,
         complete_output_bam=output_bam_path, complete_output_metrics_file=metrics_file)
-    # wait for asynchronous insert sizes process to finish
-    wait_for_insert_metrics(
-        process_handle=insert_metrics_process, sample_id=sample_name,
-        metrics_output_dir=temp_dir, delete_temp_dir=insert_szs_tmp_path)  # MUST be 'output_directory' from compute_insert_size_metrics() !
+    write_insert_size_metrics(insert_size_histogram=insert_sizes_histogram, output_directory=temp_dir,
+                              sample_id=sample_name)
     # move results from temp to output directory
     rsync_results_to_output_dir(source_directory=rsync_this_dirs_contents,
                                 destination_folder=output_dir)
@@ -0,0 +1,136 @@
+# consistency check of the chunked duplicate marking: both mates of a pair must get the same 0x400 decision,
+# also if they are processed in different chunks (by different workers) or are located on different scaffolds.
+# Run with: python -m pytest tests/
+import importlib.util
+import os
+import stat
+from pathlib import Path
+from shutil import which
+from tempfile import mkdtemp
+
+import pysam
+import pytest
+
+# the script resolves samtools and rsync at import; the code paths checked here only use pysam (in-process)
+missing_executables_dir = Path(mkdtemp(prefix='markdup-test-bin-'))
+for executable_name in ('samtools', 'rsync'):
+    if which(executable_name) is None:
+        placeholder_executable = missing_executables_dir / executable_name
+        placeholder_executable.write_text('#!/bin/sh\nexit 1\n')
+        placeholder_executable.chmod(placeholder_executable.stat().st_mode | stat.S_IXUSR)
+os.environ['PATH'] = f"{os.environ.get('PATH', '')}{os.pathsep}{missing_executables_dir}"
+script_path = Path(__file__).parent.parent / 'mark_duplicates_and_insert_sizes_for_TSO500_ichorCNA.py'
+module_spec = importlib.util.spec_from_file_location('mark_duplicates_and_insert_sizes', script_path)
+markdup = importlib.util.module_from_spec(module_spec)
+module_spec.loader.exec_module(markdup)
+
+CHUNK_LENGTH = markdup.SCAFFOLD_CHUNK_LENGTH
+SCAFFOLD_LENGTHS = {'chrA': 2 * CHUNK_LENGTH + 2_000_000, 'chrB': 1_000_000}
+READ_LENGTH = 100
+# (pair name, (scaffold, position, CIGAR, is_reverse) of read 1, (...) of read 2, base quality);
+# pairs of the same group share their pair signature; the pair with the higher base quality must be kept
+READ_PAIRS = [
+    # (a) mates in different chunks of the same scaffold
+    ('a_best', ('chrA', CHUNK_LENGTH - 1_000, '100M', False), ('chrA', CHUNK_LENGTH + 300_000, '100M', True), 30),
+    ('a_dup', ('chrA', CHUNK_LENGTH - 1_000, '100M', False), ('chrA', CHUNK_LENGTH + 300_000, '100M', True), 20),
+    # (b) mates on different scaffolds
+    ('b_best', ('chrA', 7_000_000, '100M', False), ('chrB', 500_000, '100M', True), 30),
+    ('b_dup', ('chrA', 7_000_000, '100M', False), ('chrB', 500_000, '100M', True), 20),
+    # (c) pairs straddling a chunk boundary: same unclipped 5' end, but reference_start in different chunks
+    #     (reverse read with a deletion; forward reads with 5' soft clipping; c4: the kept read does not
+    #      overlap the chunk of its competitor -> only found via CHUNK_BOUNDARY_BUFFER)
+    ('c1_best', ('chrA', CHUNK_LENGTH - 300, '100M', False), ('chrA', CHUNK_LENGTH + 10, '100M', True), 30),
+    ('c1_dup', ('chrA', CHUNK_LENGTH - 300, '100M', False), ('chrA', CHUNK_LENGTH - 10, '60M20D40M', True), 20),
+    ('c2_best', ('chrA', CHUNK_LENGTH - 400, '100M', False), ('chrA', CHUNK_LENGTH - 10, '60M20D40M', True), 31),
+    ('c2_dup', ('chrA', CHUNK_LENGTH - 400, '100M', False), ('chrA', CHUNK_LENGTH + 10, '100M', True), 21),
+    ('c3_best', ('chrA', CHUNK_LENGTH - 5, '100M', False), ('chrA', CHUNK_LENGTH + 200, '100M', True), 30),
+    ('c3_dup', ('chrA', CHUNK_LENGTH + 5, '10S90M', False), ('chrA', CHUNK_LENGTH + 200, '100M', True), 20),
+    ('c4_best', ('chrA', CHUNK_LENGTH + 45, '50S50M', False), ('chrA', CHUNK_LENGTH + 300, '100M', True), 30),
+    ('c4_dup', ('chrA', CHUNK_LENGTH - 5, '100M', False), ('chrA', CHUNK_LENGTH + 300, '100M', True), 20),
+    # no competitor
+    ('single', ('chrA', 11_000_000, '100M', False), ('chrA', 11_000_200, '100M', True), 20)]
+CHUNKS = [[('chrA', 0, CHUNK_LENGTH)], [('chrA', CHUNK_LENGTH, 2 * CHUNK_LENGTH)],
+          [('chrA', 2 * CHUNK_LENGTH, SCAFFOLD_LENGTHS['chrA'])], [('chrB', 0, SCAFFOLD_LENGTHS['chrB'])]]
+
+
+def make_read(header: pysam.AlignmentHeader, name: str, alignment: tuple, mate_alignment: tuple,
+              is_read1: bool, base_quality: int) -> pysam.AlignedSegment:
+    scaffold, position, cigar_string, is_reverse = alignment
+    mate_scaffold, mate_position, _mate_cigar_string, mate_is_reverse = mate_alignment
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.query_sequence = 'ACGT' * (READ_LENGTH // 4)
+    read.query_qualities = pysam.qualitystring_to_array(chr(33 + base_quality) * READ_LENGTH)
+    read.reference_name = scaffold
+    read.reference_start = position
+    read.cigarstring = cigar_string
+    read.mapping_quality = 60
+    read.next_reference_name = mate_scaffold
+    read.next_reference_start = mate_position
+    read.is_paired = True
+    read.is_proper_pair = scaffold == mate_scaffold
+    read.is_reverse = is_reverse
+    read.mate_is_reverse = mate_is_reverse
+    read.is_read1 = is_read1
+    read.is_read2 = not is_read1
+    return read
+
+
+@pytest.fixture(scope='module')
+def mate_fixed_bam(tmp_path_factory) -> Path:
+    # name-sorted -> 'samtools fixmate -m' (MC + ms tags, TLEN) -> coordinate-sorted + indexed
+    # (same preparation as in mark_duplicates_with_mate_cigar_parallel(), using pysam's bundled samtools)
+    temp_path = tmp_path_factory.mktemp('markdup')
+    header = pysam.AlignmentHeader.from_dict({
+        'HD': {'VN': '1.6', 'SO': 'unsorted'},
+        'SQ': [{'SN': scaffold, 'LN': scaffold_length} for scaffold, scaffold_length in SCAFFOLD_LENGTHS.items()]})
+    unsorted_bam = temp_path / 'synthetic.bam'
+    with pysam.AlignmentFile(str(unsorted_bam), 'wb', header=header) as f_unsorted:
+        for name, read1_alignment, read2_alignment, base_quality in READ_PAIRS:
+            f_unsorted.write(make_read(header, name, read1_alignment, read2_alignment, True, base_quality))
+            f_unsorted.write(make_read(header, name, read2_alignment, read1_alignment, False, base_quality))
+    namesorted_bam = temp_path / 'synthetic.namesorted.bam'
+    pysam.sort('-n', '-o', str(namesorted_bam), str(unsorted_bam))
+    fixmate_bam = temp_path / 'synthetic.fixmate.bam'
+    pysam.fixmate('-m', str(namesorted_bam), str(fixmate_bam))
+    fixed_bam = temp_path / 'synthetic.fixmate.sorted.bam'
+    pysam.sort('-o', str(fixed_bam), str(fixmate_bam))
+    pysam.index(str(fixed_bam))
+    return fixed_bam
+
+
+@pytest.fixture(scope='module')
+def duplicate_decisions(mate_fixed_bam, tmp_path_factory) -> dict:
+    # read name -> list of 0x400 decisions of all written primary alignments (one chunk after the other)
+    temp_path = tmp_path_factory.mktemp('chunks')
+    decisions = {}
+    for chunk_index, chunk_regions in enumerate(CHUNKS):
+        chunk_result = markdup.mark_duplicates_with_mate_cigar(
+            bam_path=mate_fixed_bam, temp_dir=temp_path, output_bam=temp_path / 'synthetic.markdup.bam',
+            chunk_index=chunk_index, chunk_regions=chunk_regions)
+        assert chunk_result is not None
+        _chunk_index, chunk_bam, _region_read_counts, _insert_size_histogram = chunk_result
+        with pysam.AlignmentFile(str(chunk_bam), 'rb') as f_chunk:
+            for read in f_chunk:
+                decisions.setdefault(read.query_name, []).append(read.is_duplicate)
+    return decisions
+
+
+@pytest.mark.parametrize('group', ['a', 'b', 'c1', 'c2', 'c3', 'c4'])
+def test_both_mates_get_the_same_decision(duplicate_decisions, group):
+    assert duplicate_decisions[f'{group}_best'] == [False, False]
+    assert duplicate_decisions[f'{group}_dup'] == [True, True]
+
+
+def test_every_read_is_written_once(duplicate_decisions):
+    assert sorted(duplicate_decisions) == sorted([name for name, *_pair in READ_PAIRS])
+    assert all([len(read_decisions) == 2 for read_decisions in duplicate_decisions.values()])
+
+
+def test_concordance_with_samtools_markdup(mate_fixed_bam, duplicate_decisions, tmp_path):
+    samtools_markdup_bam = tmp_path / 'synthetic.samtools_markdup.bam'
+    pysam.markdup(str(mate_fixed_bam), str(samtools_markdup_bam))
+    with pysam.AlignmentFile(str(samtools_markdup_bam), 'rb') as f_markdup:
+        samtools_duplicates = {read.query_name for read in f_markdup if read.is_duplicate}
+    chunked_duplicates = {name for name, read_decisions in duplicate_decisions.items() if any(read_decisions)}
+    assert chunked_duplicates == samtools_duplicates